@@ -1,6 +1,7 @@
 from flask import Flask
 from flask_cors import CORS
-from routes import api_blueprint
+from routes import api_blueprint, file_storage_location
+from integrity import start_scrubber
 
 def create_app():
     app = Flask(__name__)
@@ -10,12 +11,16 @@ def create_app():
         app, 
         supports_credentials=True, 
         origins=["http://localhost:*"], 
-        allow_headers=["Authorization"]
+        allow_headers=["Authorization", "X-File-Digest"],
+        expose_headers=["Repr-Digest", "X-Change-Sequence"]
     )
     
     # Register the blueprint
     app.register_blueprint(api_blueprint)
 
+    # Re-verify stored files in the background if SCRUB_RATE_MB is set
+    start_scrubber(file_storage_location)
+
     return app
 
 if __name__ == "__main__":
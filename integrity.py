@@ -0,0 +1,202 @@
+import os
+import math
+import time
+import base64
+import hashlib
+import binascii
+import threading
+from journal import read_config, commit, op_update
+
+# crc32c is an optional dependency. Without it only SHA-256 checksums are stored
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+# fcntl is only available on POSIX. Without it every process runs its own scrubber
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CHUNK_SIZE = 1024 * 1024
+
+# How long the scrubber waits after a full pass over every bucket before it starts again
+SCRUB_PASS_INTERVAL = 60 * 60
+
+# The header a client can send the digest of the uploaded file in. It uses the same syntax as Content-Digest (RFC 9530),
+# e.g. "sha-256=:<base64>:". Content-Digest and Content-MD5 themselves cover the whole multipart request body rather than
+# the file, so they are not checked
+FILE_DIGEST_HEADER = "X-File-Digest"
+
+# Algorithms a client may name in the file digest header mapped to their hashlib names
+DIGEST_ALGORITHMS = {"sha-256": "sha256", "sha-512": "sha512", "md5": "md5"}
+
+
+class _CRC32C:
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32c.crc32c(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, "big")
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+def new_hasher(name):
+    if name == "crc32c":
+        return _CRC32C()
+    return hashlib.new(name)
+
+
+# The checksums stored for every file
+def stored_algorithms():
+    if crc32c is None:
+        return ["sha256"]
+    return ["sha256", "crc32c"]
+
+
+# Copy a stream into a file, hashing each chunk as it is written so the upload is only read once. Returns the digests as bytes
+def copy_with_checksums(source, destination, algorithms):
+    hashers = {name: new_hasher(name) for name in algorithms}
+
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        destination.write(chunk)
+        for hasher in hashers.values():
+            hasher.update(chunk)
+
+    return {name: hasher.digest() for name, hasher in hashers.items()}
+
+
+# Get the digests a client expects for the uploaded file from the X-File-Digest header, keyed by hashlib name. Algorithms we
+# do not support are ignored. Raises ValueError if the header is malformed
+def expected_digests(headers):
+    expected = {}
+
+    file_digest = headers.get(FILE_DIGEST_HEADER)
+    if file_digest:
+        for item in file_digest.split(","):
+            algorithm, _, value = item.strip().partition("=")
+            algorithm = algorithm.strip().lower()
+            if algorithm not in DIGEST_ALGORITHMS:
+                continue
+            value = value.strip()
+            if len(value) < 2 or not value.startswith(":") or not value.endswith(":"):
+                raise ValueError("Invalid " + FILE_DIGEST_HEADER + " header")
+            expected[DIGEST_ALGORITHMS[algorithm]] = _b64decode(value[1:-1])
+
+    return expected
+
+
+def _b64decode(value):
+    try:
+        return base64.b64decode(value, validate=True)
+    except binascii.Error:
+        raise ValueError("Invalid base64 digest: " + value)
+
+
+# Build a Repr-Digest header value (RFC 9530) from the checksums stored in a file's config entry
+def repr_digest(file_config):
+    digests = []
+    if "sha256" in file_config:
+        digests.append("sha-256=:" + base64.b64encode(bytes.fromhex(file_config["sha256"])).decode() + ":")
+    if "crc32c" in file_config:
+        digests.append("crc32c=:" + base64.b64encode(bytes.fromhex(file_config["crc32c"])).decode() + ":")
+    return ", ".join(digests)
+
+
+# Hash a stored file, reading at no more than rate bytes per second
+def hash_file(file_path, algorithms, rate):
+    hashers = {name: new_hasher(name) for name in algorithms}
+
+    with open(file_path, "rb") as f:
+        while True:
+            started = time.monotonic()
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            for hasher in hashers.values():
+                hasher.update(chunk)
+
+            # Sleep off whatever is left of the time this chunk is allowed to take
+            remaining = len(chunk) / rate - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+# Re-verify every file in one bucket. Files uploaded before checksums were stored get their checksums filled in, and files
+# whose contents no longer match are marked as corrupt
+def scrub_bucket(bucket_path, rate):
+    config_path = os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig")
+    if not os.path.exists(config_path):
+        return
+
+    for file_id, file_config in list(read_config(config_path)["files"].items()):
+        file_path = os.path.join(bucket_path, file_id)
+
+        algorithms = [name for name in stored_algorithms() if name in file_config] or stored_algorithms()
+
+        try:
+            digests = hash_file(file_path, algorithms, rate)
+        except FileNotFoundError:
+            # The file was deleted while we were scrubbing
+            continue
+
+        # The file may have been deleted while it was being hashed, so never recreate its entry
+        if not any(name in file_config for name in algorithms):
+            commit(config_path, [op_update(["files", file_id, name], digest) for name, digest in digests.items()])
+        elif any(file_config[name] != digests[name] for name in algorithms) and not file_config.get("corrupt"):
+            print(f"Checksum mismatch for file {file_id} in bucket {os.path.basename(bucket_path)}")
+            commit(config_path, [op_update(["files", file_id, "corrupt"], True)])
+
+
+# lock_file is only passed along so the scrubber lock stays held for as long as the thread runs
+def _scrub_forever(file_storage_location, rate, lock_file):
+    while True:
+        for bucket_id in os.listdir(file_storage_location):
+            bucket_path = os.path.join(file_storage_location, bucket_id)
+            if not os.path.isdir(bucket_path):
+                continue
+            try:
+                scrub_bucket(bucket_path, rate)
+            except Exception as e:
+                print(f"Scrubber error in bucket {bucket_id}: {e}")
+
+        time.sleep(SCRUB_PASS_INTERVAL)
+
+
+# Start the background scrubber if SCRUB_RATE_MB (MB per second) is set. With several gunicorn workers only the worker that
+# gets the scrubber lock runs it
+def start_scrubber(file_storage_location):
+    rate = os.getenv("SCRUB_RATE_MB")
+    if not rate:
+        return None
+
+    rate = float(rate)
+
+    if not math.isfinite(rate) or rate <= 0:
+        raise ValueError("SCRUB_RATE_MB must be a positive number")
+
+    rate = rate * 1024 * 1024
+
+    lock_file = None
+    if fcntl is not None:
+        lock_file = open(os.path.join(file_storage_location, "FILESERVER_SCRUBBER.lock"), "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+
+    thread = threading.Thread(target=_scrub_forever, args=(file_storage_location, rate, lock_file), daemon=True)
+    thread.start()
+    return thread
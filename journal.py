@@ -0,0 +1,445 @@
+import os
+import json
+import zlib
+import copy
+import threading
+from contextlib import contextmanager
+
+# fcntl is only available on POSIX. Without it the journal is still safe for a single process (e.g. the development server)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Once a journal grows past this size it is folded back into its .fsconfig snapshot
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", 1024 * 1024))
+
+# How many entries a change feed keeps before the oldest are dropped
+CHANGE_FEED_LENGTH = int(os.getenv("CHANGE_FEED_LENGTH", 1000))
+
+if CHANGE_FEED_LENGTH < 1:
+    raise ValueError("CHANGE_FEED_LENGTH must be a positive integer")
+
+# The key a snapshot stores the number of the last journal record it contains under. It is removed again when loading
+SNAPSHOT_RECORD_KEY = "FILESERVER_JOURNAL_RECORD"
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+# Every .fsconfig file is a snapshot, and every mutation is appended to "<config>.journal" as one line:
+#   "<crc32 as 8 hex digits> {"n": <record number>, "ops": <json list of operations>}\n"
+# An operation is a list [op, path, value] where path is a list of keys into the config. Records are numbered one after
+# another and replay skips the ones the snapshot already contains, which is what makes compaction safe if the process dies
+# between replacing the snapshot and truncating the journal.
+def op_set(path, value):
+    return ["set", path, value]
+
+# Like op_set, but only if everything above path still exists
+def op_update(path, value):
+    return ["update", path, value]
+
+def op_setdefault(path, value):
+    return ["setdefault", path, value]
+
+def op_delete(path):
+    return ["delete", path, None]
+
+def op_add(path, value):
+    return ["add", path, value]
+
+def op_discard(path, value):
+    return ["discard", path, value]
+
+# Append an entry to the change feed at path, numbering it after the previous entry
+def op_change(path, value):
+    return ["change", path, value]
+
+
+# Get parent[key] so that it can be modified. copied holds the ids of the containers that have already been copied for this
+# update; anything else may be shared with a config other requests are still reading, so it is shallow-copied first. With
+# copied set to None the config isn't shared and is modified in place
+def _writable(parent, key, copied):
+    child = parent[key]
+    if copied is not None and id(child) not in copied:
+        child = copy.copy(child)
+        parent[key] = child
+        copied.add(id(child))
+    return child
+
+
+# Apply an operation to a config. Only the dicts and lists along the operation's path are copied (see _writable), so
+# updating a large config costs as much as the path rather than the whole config
+def apply_operation(config, operation, copied=None):
+    op, path, value = operation
+
+    parent = config
+    for key in path[:-1]:
+        if op in ["set", "setdefault", "change"] and key not in parent:
+            parent[key] = {}
+        elif not isinstance(parent, dict) or key not in parent:
+            return
+        parent = _writable(parent, key, copied)
+
+    key = path[-1]
+
+    if op == "set":
+        parent[key] = value
+    elif op == "update":
+        parent[key] = value
+    elif op == "setdefault":
+        parent.setdefault(key, value)
+    elif op == "delete":
+        parent.pop(key, None)
+    elif op == "add":
+        if key in parent and value not in parent[key]:
+            _writable(parent, key, copied).append(value)
+    elif op == "discard":
+        if key in parent and value in parent[key]:
+            _writable(parent, key, copied).remove(value)
+    elif op == "change":
+        if key not in parent:
+            parent[key] = {"sequence": 0, "entries": []}
+        feed = _writable(parent, key, copied)
+        _writable(feed, "entries", copied)
+        feed["sequence"] += 1
+        feed["entries"].append(dict(value, seq=feed["sequence"]))
+        del feed["entries"][:-CHANGE_FEED_LENGTH]
+    else:
+        raise ValueError("Unknown journal operation: " + str(op))
+
+
+# Apply the records numbered after applied to a config. Returns the number of the last record applied
+def apply_records(config, records, applied, copied=None):
+    for record in records:
+        if record["n"] <= applied:
+            continue
+        for operation in record["ops"]:
+            apply_operation(config, operation, copied)
+        applied = record["n"]
+    return applied
+
+
+def encode_record(number, operations):
+    payload = json.dumps({"n": number, "ops": operations}, separators=(",", ":")).encode("utf-8")
+    return b"%08x " % zlib.crc32(payload) + payload + b"\n"
+
+
+# Decode the valid prefix of a journal. Returns the records and the number of bytes they take up; anything after the first
+# torn or corrupt line was never acknowledged to a client and is ignored
+def decode_records(data):
+    records = []
+    consumed = 0
+
+    while True:
+        end = data.find(b"\n", consumed)
+        if end == -1:
+            break
+
+        line = data[consumed:end]
+        if len(line) < 9 or line[8:9] != b" ":
+            break
+
+        payload = line[9:]
+        try:
+            if int(line[:8], 16) != zlib.crc32(payload):
+                break
+            records.append(json.loads(payload))
+        except ValueError:
+            break
+
+        consumed = end + 1
+
+    return records, consumed
+
+
+def fsync_directory(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Atomically replace a config file so a crash leaves either the old or the new version, never a truncated one. record is the
+# number of the last journal record the config contains
+def write_snapshot(config_path, config, record=0):
+    temp_path = config_path + ".tmp"
+
+    with open(temp_path, "w") as f:
+        json.dump(dict(config, **{SNAPSHOT_RECORD_KEY: record}), f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, config_path)
+    fsync_directory(os.path.dirname(config_path))
+
+
+# Create a new config file along with the lock file its journal is guarded by
+def create_config(config_path, config):
+    write_snapshot(config_path, config)
+    os.close(os.open(config_path + ".lock", os.O_RDWR | os.O_CREAT, 0o644))
+
+
+class _Batch:
+    def __init__(self):
+        self.records = []
+        self.done = False
+        self.error = None
+
+
+class MetadataJournal:
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self.journal_path = config_path + ".journal"
+        self.lock_path = config_path + ".lock"
+
+        # Cached view of the config, and how much of the snapshot and journal it reflects
+        self._state = None
+        self._snapshot_key = None
+        self._offset = 0
+        self._applied = 0
+        self._read_lock = threading.Lock()
+
+        # Group commit: writers that arrive while a flush is in progress queue up in the open batch and are written
+        # together with a single fsync by whichever of them becomes the next leader. This only groups threads of one
+        # process; writers in different gunicorn workers take turns on the file lock and each fsync their own batch
+        self._condition = threading.Condition()
+        self._open_batch = _Batch()
+        self._flushing = False
+
+    # Lock shared between gunicorn workers. A new file description is opened every time so threads of the same process
+    # exclude each other as well. Yields whether the lock is held.
+    #
+    # Only writers create the lock file. It is missing for a config that has never been written through the journal (so
+    # there is no journal to coordinate over) or while its bucket is being deleted, and recreating it from a read then
+    # would leave a file behind in a directory shutil.rmtree is removing
+    @contextmanager
+    def _file_lock(self, exclusive, create=False):
+        if fcntl is None:
+            yield True
+            return
+
+        try:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT if create else os.O_RDONLY, 0o644)
+        except FileNotFoundError:
+            yield False
+            return
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    # Load the snapshot and replay the journal over it. Returns the config, how much of the journal was read and the number of
+    # the last record applied
+    def _load(self):
+        with open(self.config_path, "r") as f:
+            config = json.load(f)
+        applied = config.pop(SNAPSHOT_RECORD_KEY, 0)
+
+        try:
+            with open(self.journal_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+
+        records, consumed = decode_records(data)
+        applied = apply_records(config, records, applied)
+
+        return config, consumed, applied
+
+    # Get the current config. The returned dict is shared with other requests and must not be modified
+    def read(self):
+        with self._read_lock:
+            with self._file_lock(exclusive=False):
+                stat = os.stat(self.config_path)
+                snapshot_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+                # The snapshot was replaced by a compaction, so start over from the new one
+                if snapshot_key != self._snapshot_key:
+                    self._state, self._offset, self._applied = self._load()
+                    self._snapshot_key = snapshot_key
+                    return self._state
+
+                try:
+                    with open(self.journal_path, "rb") as f:
+                        f.seek(self._offset)
+                        data = f.read()
+                except FileNotFoundError:
+                    data = b""
+
+            records, consumed = decode_records(data)
+            if any(record["n"] > self._applied for record in records):
+                # Copy on write so requests still holding the previous state never see it change
+                state = dict(self._state)
+                self._applied = apply_records(state, records, self._applied, {id(state)})
+                self._state = state
+            self._offset += consumed
+
+            return self._state
+
+    # Durably record a list of operations. Returns once they have been fsynced
+    def commit(self, operations):
+        with self._condition:
+            batch = self._open_batch
+            batch.records.append(operations)
+
+            while self._flushing and not batch.done:
+                self._condition.wait()
+
+            if batch.done:
+                if batch.error:
+                    raise batch.error
+                return
+
+            self._flushing = True
+            self._open_batch = _Batch()
+
+        try:
+            self._flush(batch.records)
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self._condition:
+                batch.done = True
+                self._flushing = False
+                self._condition.notify_all()
+
+        if batch.error:
+            raise batch.error
+
+    def _flush(self, records):
+        with self._file_lock(exclusive=True, create=True):
+            created = not os.path.exists(self.journal_path)
+
+            fd = os.open(self.journal_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                # A previous writer died mid-append, so cut the torn line off before writing after it
+                size = os.fstat(fd).st_size
+                if size:
+                    os.lseek(fd, size - 1, os.SEEK_SET)
+                    if os.read(fd, 1) != b"\n":
+                        self._truncate_invalid_tail(fd)
+
+                number = self._last_record_number(fd)
+                os.write(fd, b"".join(encode_record(number + i + 1, operations) for i, operations in enumerate(records)))
+                os.fsync(fd)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+
+            if created:
+                fsync_directory(os.path.dirname(self.journal_path))
+
+            if size > JOURNAL_COMPACT_BYTES:
+                self._try_compact()
+
+    # Get the number of the last record in the journal, or in the snapshot if the journal is empty. The journal must end with
+    # a complete line
+    def _last_record_number(self, fd):
+        size = os.fstat(fd).st_size
+
+        if size == 0:
+            with open(self.config_path, "r") as f:
+                return json.load(f).get(SNAPSHOT_RECORD_KEY, 0)
+
+        # Read backwards until the start of the last line is found
+        length = 4096
+        while True:
+            start = max(0, size - length)
+            os.lseek(fd, start, os.SEEK_SET)
+            data = os.read(fd, size - start)
+            newline = data.rfind(b"\n", 0, len(data) - 1)
+            if newline != -1 or start == 0:
+                break
+            length *= 2
+
+        records, _ = decode_records(data[newline + 1:])
+        if records:
+            return records[0]["n"]
+
+        # The last line is corrupt, so drop it along with anything else after the valid part of the journal
+        self._truncate_invalid_tail(fd)
+        return self._last_record_number(fd)
+
+    def _truncate_invalid_tail(self, fd):
+        size = os.fstat(fd).st_size
+        os.lseek(fd, 0, os.SEEK_SET)
+        _, consumed = decode_records(os.read(fd, size))
+        if consumed != size:
+            os.ftruncate(fd, consumed)
+            os.fsync(fd)
+
+    # Compact, but only log a failure (e.g. ENOSPC while writing the snapshot). The records are already durable in the
+    # journal, so their writers must not see an error, and the next write past the threshold tries again
+    def _try_compact(self):
+        try:
+            self._compact()
+        except Exception as e:
+            print(f"Journal compaction error for {self.config_path}: {e}")
+
+    # Fold the journal into the snapshot. Must be called with the exclusive file lock held
+    def _compact(self):
+        config, _, applied = self._load()
+        write_snapshot(self.config_path, config, applied)
+
+        # If we die here the old journal is left behind, but every record in it is skipped as the snapshot already contains it
+        with open(self.journal_path, "r+b") as f:
+            f.truncate(0)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Clean up after a crash: drop any torn or corrupt tail and compact if the journal has grown large
+    def recover(self):
+        with self._file_lock(exclusive=True) as locked:
+            if not locked or not os.path.exists(self.journal_path):
+                return
+
+            fd = os.open(self.journal_path, os.O_RDWR)
+            try:
+                self._truncate_invalid_tail(fd)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+
+            if size > JOURNAL_COMPACT_BYTES:
+                self._try_compact()
+
+
+# Get the (per process) journal for a config file, recovering it the first time it is used
+def get_journal(config_path):
+    with _journals_lock:
+        journal = _journals.get(config_path)
+    if journal is not None:
+        return journal
+
+    # Recovery can wait on other workers' locks and compact, so it must not hold up every other config in this process.
+    # If two threads race here both recover (which is harmless) and the first one to finish wins
+    journal = MetadataJournal(config_path)
+    journal.recover()
+
+    with _journals_lock:
+        return _journals.setdefault(config_path, journal)
+
+
+# Drop the cached journal for a config file that has been deleted (e.g. with its bucket)
+def forget_journal(config_path):
+    with _journals_lock:
+        _journals.pop(config_path, None)
+
+
+def read_config(config_path):
+    return get_journal(config_path).read()
+
+
+def commit(config_path, operations):
+    get_journal(config_path).commit(operations)
@@ -1,8 +1,12 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify, send_file, Response
 from token_verification import verifyUser
+from journal import read_config, commit, forget_journal, create_config, get_journal, fsync_directory
+from journal import op_set, op_setdefault, op_delete, op_add, op_discard, op_change
+from integrity import copy_with_checksums, expected_digests, stored_algorithms, repr_digest
 import os
 import uuid
 import json
+import math
 from datetime import datetime
 from dotenv import load_dotenv
 import time
@@ -18,18 +22,23 @@ file_storage_location = os.getenv("FILE_STORAGE_LOCATION")
 if not file_storage_location:
     raise ValueError("FILE_STORAGE_LOCATION is not set")
 
+BUCKETS_CONFIG = os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig")
+PERMISSIONS_CONFIG = os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig")
+
 # Create the config file if it doesn't exist
-if not os.path.exists(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig")):
-    with open(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig"), "w") as f:
-        json.dump({}, f)
+if not os.path.exists(BUCKETS_CONFIG):
+    create_config(BUCKETS_CONFIG, {})
 
 # Create the permissions file if it doesn't exist
-if not os.path.exists(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig")):
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "w") as f:
-        DEFAULT_ADMIN = os.getenv("DEFAULT_ADMIN")
-        if not DEFAULT_ADMIN:
-            raise ValueError("DEFAULT_ADMIN is not set")
-        json.dump({DEFAULT_ADMIN: {"permissions": {"SYSTEM": "admin", "*": "admin"}, "buckets": ["*"]}}, f)
+if not os.path.exists(PERMISSIONS_CONFIG):
+    DEFAULT_ADMIN = os.getenv("DEFAULT_ADMIN")
+    if not DEFAULT_ADMIN:
+        raise ValueError("DEFAULT_ADMIN is not set")
+    create_config(PERMISSIONS_CONFIG, {DEFAULT_ADMIN: {"permissions": {"SYSTEM": "admin", "*": "admin"}, "buckets": ["*"]}})
+
+# Replay (and repair) any journals left behind by a previous run
+get_journal(BUCKETS_CONFIG)
+get_journal(PERMISSIONS_CONFIG)
 
 MAXIMUM_FILE_SIZE = os.getenv("MAXIMUM_FILE_SIZE")
 
@@ -38,12 +47,21 @@ if not MAXIMUM_FILE_SIZE:
 
 MAXIMUM_FILE_SIZE = int(MAXIMUM_FILE_SIZE)
 
+# The longest a single changes request (long-poll or server-sent events stream) is held open for (in seconds). This has to
+# stay below gunicorn's worker timeout (30 seconds by default), or sync workers are killed while they wait
+MAXIMUM_CHANGES_WAIT = 25
+
+# How often a waiting changes request checks the bucket for new changes (in seconds)
+CHANGES_POLL_INTERVAL = 0.5
+
+# How often a server-sent events stream sends a keep-alive comment when nothing has changed (in seconds)
+CHANGES_KEEP_ALIVE = 15
+
 
 # This is a helper function to get the permissions for the user based on the bucket (read, write, admin)
 def get_permissions(user, bucket):
 
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "r") as f:
-        permissions = json.load(f)
+    permissions = read_config(PERMISSIONS_CONFIG)
 
     if user not in permissions:
         return None
@@ -57,6 +75,57 @@ def get_permissions(user, bucket):
     return permissions[user]["permissions"][bucket]
 
 
+# This is a helper function to get the information returned to clients for a file in a bucket config
+def get_file_info(file_id, file_config):
+    return {
+        "file_id": file_id,
+        "file_name": file_config["file_name"],
+        "file_size": file_config["file_size"],
+        "created_by": file_config["created_by"],
+        "created_at": file_config["created_at"],
+        "sha256": file_config.get("sha256"),
+        "crc32c": file_config.get("crc32c"),
+        "corrupt": file_config.get("corrupt", False)
+    }
+
+
+# This is a helper function to get the current sequence number of a bucket's change feed
+def get_sequence(bucket_config):
+    return bucket_config.get("changes", {"sequence": 0})["sequence"]
+
+
+# This is a helper function to get the changes in a bucket after the sequence number since. Returns the bucket's current
+# sequence number and the changes, which are None if changes the client has not seen have already been dropped from the feed
+def get_changes_since(bucket_config, since):
+    feed = bucket_config.get("changes", {"sequence": 0, "entries": []})
+
+    if since > feed["sequence"]:
+        return feed["sequence"], None
+
+    if feed["entries"] and since < feed["entries"][0]["seq"] - 1:
+        return feed["sequence"], None
+
+    changes = []
+    for entry in feed["entries"]:
+        if entry["seq"] <= since:
+            continue
+
+        change = {
+            "seq": entry["seq"],
+            "action": entry["action"],
+            "file_id": entry["file_id"],
+            "at": entry["at"]
+        }
+
+        # Include the file's current information so clients don't have to list the bucket again
+        if entry["action"] == "upload" and entry["file_id"] in bucket_config["files"]:
+            change["file"] = get_file_info(entry["file_id"], bucket_config["files"][entry["file_id"]])
+
+        changes.append(change)
+
+    return feed["sequence"], changes
+
+
 # This function authenticates the user and checks if they have access to the channel (if channel_id is provided)
 @api_blueprint.before_request
 def verify_token():
@@ -85,8 +154,7 @@ def get_buckets():
     
     user = verifyUser(request.headers.get('Authorization').split(" ")[1], file_storage_location)
 
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "r") as f:
-        permissions = json.load(f)
+    permissions = read_config(PERMISSIONS_CONFIG)
 
     if user not in permissions:
         return jsonify([])
@@ -99,8 +167,7 @@ def get_buckets():
         buckets = [f for f in os.listdir(file_storage_location) if os.path.isdir(os.path.join(file_storage_location, f))]
 
     # Get the bucket information from the FILESERVER_BUCKETS.fsconfig file
-    with open(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig"), "r") as f:
-        buckets_info = json.load(f)
+    buckets_info = read_config(BUCKETS_CONFIG)
 
     # Add the bucket information to the buckets list
     bucket_data = []
@@ -141,56 +208,23 @@ def create_bucket():
 
     os.makedirs(bucket_path)
 
-    # Add the bucket name and id to the FILESERVER_BUCKETS.fsconfig file... it is a json file that contains all the buckets
-
-    # Wait for the buckets write lock to be released
-    while os.path.exists(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig.lock")):
-        time.sleep(0.1)
+    # Add the bucket's config to the bucket before the bucket is listed anywhere
+    create_config(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"), {"files": {}})
 
-    # Create the buckets write lock
-    with open(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig.lock"), os.O_CREAT | os.O_EXCL) as f:
-        f.write(user)
-
-    with open(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig"), "r") as f:
-        buckets = json.load(f)
-
-    buckets[bucket_id] = {
-        "name": bucket_name,
-        "created_by": user,
-        "created_at": datetime.now().isoformat()
-    }
-
-    with open(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig"), "w") as f:
-        json.dump(buckets, f)
-
-    # Release the buckets write lock
-    os.remove(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig.lock"))
+    # Add the bucket name and id to the FILESERVER_BUCKETS.fsconfig file... it is a json file that contains all the buckets
+    commit(BUCKETS_CONFIG, [
+        op_set([bucket_id], {
+            "name": bucket_name,
+            "created_by": user,
+            "created_at": datetime.now().isoformat()
+        })
+    ])
 
     # Add the bucket to the user's permissions
-
-    # Wait for the permissions write lock to be released
-    while os.path.exists(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock")):
-        time.sleep(0.1)
-
-    # Create the permissions write lock
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"), os.O_CREAT | os.O_EXCL) as f:
-        f.write(user)
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "r") as f:
-        permissions = json.load(f)
-
-    permissions[user]["buckets"].append(bucket_id)
-    permissions[user]["permissions"][bucket_id] = "admin"
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "w") as f:
-        json.dump(permissions, f)
-
-    # Release the permissions write lock
-    os.remove(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"))
-
-    # Add the bucket's config to the bucket
-    with open(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"), "w") as f:
-        json.dump({"files": {}}, f)
+    commit(PERMISSIONS_CONFIG, [
+        op_add([user, "buckets"], bucket_id),
+        op_set([user, "permissions", bucket_id], "admin")
+    ])
 
     return jsonify({"bucket_id": bucket_id})
 
@@ -211,50 +245,17 @@ def delete_bucket(bucket_id):
         return jsonify({"error": "Bucket does not exist"}), 404
 
     # Delete the bucket from the FILESERVER_BUCKETS.fsconfig file
-    
-    # Wait for the buckets write lock to be released
-    while os.path.exists(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig.lock")):
-        time.sleep(0.1)
-
-    # Create the buckets write lock
-    with open(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig.lock"), os.O_CREAT | os.O_EXCL) as f:
-        f.write(user)
-
-    with open(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig"), "r") as f:
-        buckets = json.load(f)
-
-    del buckets[bucket_id]
-
-    with open(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig"), "w") as f:
-        json.dump(buckets, f)
-
-    # Release the buckets write lock
-    os.remove(os.path.join(file_storage_location, "FILESERVER_BUCKETS.fsconfig.lock"))
+    commit(BUCKETS_CONFIG, [op_delete([bucket_id])])
 
     # Delete the bucket from the user's permissions
-
-    # Wait for the permissions write lock to be released
-    while os.path.exists(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock")):
-        time.sleep(0.1)
-
-    # Create the permissions write lock
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"), os.O_CREAT | os.O_EXCL) as f:
-        f.write(user)
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "r") as f:
-        permissions = json.load(f)
-
-    permissions[user]["buckets"].remove(bucket_id)
-    del permissions[user]["permissions"][bucket_id]
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "w") as f:
-        json.dump(permissions, f)
-
-    # Release the permissions write lock
-    os.remove(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"))
+    commit(PERMISSIONS_CONFIG, [
+        op_discard([user, "buckets"], bucket_id),
+        op_delete([user, "permissions", bucket_id])
+    ])
 
     # Delete the bucket from the file storage location
     shutil.rmtree(bucket_path)
+    forget_journal(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"))
 
     return jsonify({"success": True})
     
@@ -274,21 +275,17 @@ def get_files(bucket_id):
     if permissions not in ["admin", "read", "write"]:
         return jsonify({"error": "You do not have permission to get the list of files in this bucket"}), 403
     
-    with open(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"), "r") as f:
-        bucket_config = json.load(f)
+    bucket_config = read_config(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"))
 
     file_data = []
     for file_id in bucket_config["files"]:
-        file_data.append({
-            "file_id": file_id,
-            "file_name": bucket_config["files"][file_id]["file_name"],
-            "file_size": bucket_config["files"][file_id]["file_size"],
-            "created_by": bucket_config["files"][file_id]["created_by"],
-            "created_at": bucket_config["files"][file_id]["created_at"]
-        })
+        file_data.append(get_file_info(file_id, bucket_config["files"][file_id]))
 
+    # The change feed sequence this listing matches, so clients can follow the changes from here
+    response = jsonify(file_data)
+    response.headers["X-Change-Sequence"] = str(get_sequence(bucket_config))
 
-    return jsonify(file_data)
+    return response
 
     
 # Upload a file to a bucket
@@ -310,6 +307,12 @@ def upload_file(bucket_id):
 
     if not file:
         return jsonify({"error": "No file provided"}), 400
+
+    # The client can optionally send the digest of the uploaded file (not of the whole request body) in an X-File-Digest header
+    try:
+        expected = expected_digests(request.headers)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     file_id = str(uuid.uuid4())
     while os.path.exists(os.path.join(bucket_path, file_id)):
@@ -327,35 +330,37 @@ def upload_file(bucket_id):
 
     file_path = os.path.join(bucket_path, file_id)
 
+    # Compute the checksums while the upload is being copied so it is only read once
     with open(file_path, "wb") as f:
         file.stream.seek(0)
-        shutil.copyfileobj(file.stream, f)
-
-    # Wait for the bucket config write lock to be released
-    while os.path.exists(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig.lock")):
-        time.sleep(0.1)
-
-    # Create the bucket config write lock
-    with open(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig.lock"), os.O_CREAT | os.O_EXCL) as f:
-        f.write(user)
-
-    with open(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"), "r") as f:
-        bucket_config = json.load(f)
-
-    bucket_config["files"][file_id] = {
-        "file_name": file_name,
-        "file_size": file_size_mb,
-        "created_by": user,
-        "created_at": datetime.now().isoformat()
-    }
-
-    with open(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"), "w") as f:
-        json.dump(bucket_config, f)
-
-    # Release the bucket config write lock
-    os.remove(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig.lock"))
+        digests = copy_with_checksums(file.stream, f, set(stored_algorithms()) | set(expected))
+        f.flush()
+        os.fsync(f.fileno())
+
+    for algorithm in expected:
+        if digests[algorithm] != expected[algorithm]:
+            os.remove(file_path)
+            return jsonify({"error": "The uploaded file does not match the provided " + algorithm + " digest"}), 400
+
+    # Make sure the file is on disk before the bucket config that lists it is
+    fsync_directory(bucket_path)
+
+    commit(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"), [
+        op_set(["files", file_id], {
+            "file_name": file_name,
+            "file_size": file_size_mb,
+            "created_by": user,
+            "created_at": datetime.now().isoformat(),
+            **{algorithm: digests[algorithm].hex() for algorithm in stored_algorithms()}
+        }),
+        op_change(["changes"], {
+            "action": "upload",
+            "file_id": file_id,
+            "at": datetime.now().isoformat()
+        })
+    ])
 
-    return jsonify({"file_id": file_id})
+    return jsonify({"file_id": file_id, "sha256": digests["sha256"].hex()})
 
 
 # Delete a file from a bucket
@@ -378,24 +383,14 @@ def delete_file(bucket_id, file_id):
     if not os.path.exists(file_path):
         return jsonify({"error": "File does not exist"}), 404
 
-    # Wait for the bucket config write lock to be released
-    while os.path.exists(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig.lock")):
-        time.sleep(0.1)
-
-    # Create the bucket config write lock
-    with open(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig.lock"), os.O_CREAT | os.O_EXCL) as f:
-        f.write(user)
-
-    with open(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"), "r") as f:
-        bucket_config = json.load(f)
-
-    del bucket_config["files"][file_id]
-
-    with open(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"), "w") as f:
-        json.dump(bucket_config, f)
-
-    # Release the bucket config write lock
-    os.remove(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig.lock"))
+    commit(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"), [
+        op_delete(["files", file_id]),
+        op_change(["changes"], {
+            "action": "delete",
+            "file_id": file_id,
+            "at": datetime.now().isoformat()
+        })
+    ])
 
     # Delete the file from the file storage location
     os.remove(file_path)
@@ -423,12 +418,101 @@ def get_file(bucket_id, file_id):
         return jsonify({"error": "File does not exist"}), 404
     
     # Get the file name
-    with open(bucket_path + "/FILESERVER_BUCKET_CONFIG.fsconfig", "r") as f:
-        bucket_config = json.load(f)
+    bucket_config = read_config(os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig"))
 
     file_name = bucket_config["files"][file_id]["file_name"]
 
-    return send_file(file_path, as_attachment=True, download_name=file_name)
+    response = send_file(file_path, as_attachment=True, download_name=file_name)
+
+    # Let the client verify the download (or just fetch the checksum with a HEAD request)
+    digest = repr_digest(bucket_config["files"][file_id])
+    if digest:
+        response.headers["Repr-Digest"] = digest
+
+    return response
+
+
+# Get the changes (uploads and deletes) in a bucket after a sequence number. With ?wait=<seconds> the request is held open
+# until there is a change or the time runs out, and with "Accept: text/event-stream" the changes are streamed as
+# server-sent events
+@api_blueprint.route("/buckets/<bucket_id>/changes", methods=["GET"])
+def get_changes(bucket_id):
+    user = verifyUser(request.headers.get('Authorization').split(" ")[1], file_storage_location)
+
+    bucket_path = os.path.join(file_storage_location, bucket_id)
+
+    if not os.path.exists(bucket_path):
+        return jsonify({"error": "Bucket does not exist"}), 404
+
+    permissions = get_permissions(user, bucket_id)
+
+    if permissions not in ["admin", "read", "write"]:
+        return jsonify({"error": "You do not have permission to get the changes in this bucket"}), 403
+
+    try:
+        # EventSource sends the last sequence number it saw when it reconnects
+        since = int(request.headers.get("Last-Event-ID", request.args.get("since", 0)))
+        wait = float(request.args.get("wait", 0))
+    except ValueError:
+        return jsonify({"error": "since must be an integer and wait must be a number"}), 400
+
+    if not math.isfinite(wait) or wait < 0:
+        return jsonify({"error": "wait must be a non-negative number"}), 400
+
+    wait = min(wait, MAXIMUM_CHANGES_WAIT)
+
+    config_path = os.path.join(bucket_path, "FILESERVER_BUCKET_CONFIG.fsconfig")
+
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        return Response(stream_changes(config_path, since), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            sequence, changes = get_changes_since(read_config(config_path), since)
+        except FileNotFoundError:
+            return jsonify({"error": "Bucket does not exist"}), 404
+
+        if changes is None:
+            return jsonify({
+                "error": "Changes since " + str(since) + " are no longer available. List the bucket's files again.",
+                "sequence": sequence
+            }), 410
+
+        if changes or time.monotonic() >= deadline:
+            return jsonify({"sequence": sequence, "changes": changes})
+
+        time.sleep(CHANGES_POLL_INTERVAL)
+
+
+# Stream the changes in a bucket as server-sent events. The stream ends after MAXIMUM_CHANGES_WAIT seconds so it doesn't hold
+# a worker for good, and EventSource then reconnects with Last-Event-ID to carry on where it left off
+def stream_changes(config_path, since):
+    deadline = time.monotonic() + MAXIMUM_CHANGES_WAIT
+    last_sent = time.monotonic()
+
+    yield "retry: 1000\n\n"
+
+    while time.monotonic() < deadline:
+        try:
+            sequence, changes = get_changes_since(read_config(config_path), since)
+        except FileNotFoundError:
+            return
+
+        if changes is None:
+            yield "event: reset\ndata: " + json.dumps({"sequence": sequence}) + "\n\n"
+            return
+
+        for change in changes:
+            yield "id: " + str(change["seq"]) + "\nevent: change\ndata: " + json.dumps(change) + "\n\n"
+            since = change["seq"]
+            last_sent = time.monotonic()
+
+        if time.monotonic() - last_sent >= CHANGES_KEEP_ALIVE:
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+
+        time.sleep(CHANGES_POLL_INTERVAL)
     
 
 # Set the permission level for a user on a bucket
@@ -460,39 +544,20 @@ def set_permission(bucket_id):
     if permission not in ["admin", "read", "write", "remove"]:
         return jsonify({"error": "Invalid permission. Must be one of: admin, read, write, remove."}), 400
 
-    # Wait for the permissions write lock to be released
-    while os.path.exists(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock")):
-        time.sleep(0.1)
-
-    # Create the permissions write lock
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"), os.O_CREAT | os.O_EXCL) as f:
-        f.write(user)
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "r") as f:
-        permissions = json.load(f)
-
     if permission == "remove":
-        if user in permissions and bucket_id in permissions[user]["permissions"]:
-            del permissions[user]["permissions"][bucket_id]
-        if user in permissions and bucket_id in permissions[user]["buckets"]:
-            permissions[user]["buckets"].remove(bucket_id)
+        commit(PERMISSIONS_CONFIG, [
+            op_delete([user, "permissions", bucket_id]),
+            op_discard([user, "buckets"], bucket_id)
+        ])
     else:
-
-        if user not in permissions:
-            permissions[user] = {
+        commit(PERMISSIONS_CONFIG, [
+            op_setdefault([user], {
                 "permissions": {},
                 "buckets": []
-            }
-
-        permissions[user]["permissions"][bucket_id] = permission
-        if bucket_id not in permissions[user]["buckets"]:
-            permissions[user]["buckets"].append(bucket_id)
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "w") as f:
-        json.dump(permissions, f)
-
-    # Release the permissions write lock
-    os.remove(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"))
+            }),
+            op_set([user, "permissions", bucket_id], permission),
+            op_add([user, "buckets"], bucket_id)
+        ])
 
     return jsonify({"success": True})
 
@@ -514,32 +579,15 @@ def create_system_admin():
     if not new_admin:
         return jsonify({"error": "New admin is required"}), 400
     
-    # Wait for the permissions write lock to be released
-    while os.path.exists(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock")):
-        time.sleep(0.1)
-
-    # Create the permissions write lock
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"), os.O_CREAT | os.O_EXCL) as f:
-        f.write(user)
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "r") as f:
-        permissions = json.load(f)
-
-    if new_admin in permissions:
-        permissions[new_admin]["permissions"]["SYSTEM"] = "admin"
-        permissions[new_admin]["permissions"]["*"] = "admin"
-        permissions[new_admin]["buckets"].append("*")
-    else:
-        permissions[new_admin] = {
-            "permissions": {"SYSTEM": "admin", "*": "admin"},
-            "buckets": ["*"]
-        }
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "w") as f:
-        json.dump(permissions, f)
-
-    # Release the permissions write lock
-    os.remove(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"))
+    commit(PERMISSIONS_CONFIG, [
+        op_setdefault([new_admin], {
+            "permissions": {},
+            "buckets": []
+        }),
+        op_set([new_admin, "permissions", "SYSTEM"], "admin"),
+        op_set([new_admin, "permissions", "*"], "admin"),
+        op_add([new_admin, "buckets"], "*")
+    ])
 
     return jsonify({"success": True})
         
@@ -562,30 +610,10 @@ def delete_system_admin():
     if not admin_to_delete:
         return jsonify({"error": "Admin to delete is required"}), 400
     
-    # Wait for the permissions write lock to be released
-    while os.path.exists(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock")):
-        time.sleep(0.1)
-
-    # Create the permissions write lock
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"), os.O_CREAT | os.O_EXCL) as f:
-        f.write(user)
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "r") as f:
-        permissions = json.load(f)
-
-    if admin_to_delete in permissions:
-        if "SYSTEM" in permissions[admin_to_delete]["permissions"]:
-            del permissions[admin_to_delete]["permissions"]["SYSTEM"]
-        if "*" in permissions[admin_to_delete]["permissions"]:
-            del permissions[admin_to_delete]["permissions"]["*"]
-        if "*" in permissions[admin_to_delete]["buckets"]:
-            permissions[admin_to_delete]["buckets"].remove("*")
-            
-
-    with open(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig"), "w") as f:
-        json.dump(permissions, f)
-
-    # Release the permissions write lock
-    os.remove(os.path.join(file_storage_location, "FILESERVER_PERMISSIONS.fsconfig.lock"))
+    commit(PERMISSIONS_CONFIG, [
+        op_delete([admin_to_delete, "permissions", "SYSTEM"]),
+        op_delete([admin_to_delete, "permissions", "*"]),
+        op_discard([admin_to_delete, "buckets"], "*")
+    ])
 
     return jsonify({"success": True})
@@ -0,0 +1,56 @@
+import hashlib
+import pytest
+import journal
+import integrity
+from journal import create_config, read_config, commit, op_set, op_delete
+
+
+@pytest.fixture(autouse=True)
+def fresh_journals(monkeypatch):
+    monkeypatch.setattr(journal, "_journals", {})
+
+
+def make_bucket(tmp_path, files):
+    config_path = str(tmp_path / "FILESERVER_BUCKET_CONFIG.fsconfig")
+    create_config(config_path, {"files": {}})
+    for file_id, (file_config, data) in files.items():
+        (tmp_path / file_id).write_bytes(data)
+        commit(config_path, [op_set(["files", file_id], file_config)])
+    return config_path
+
+
+def test_scrub_backfills_checksums_and_marks_corrupt_files(tmp_path):
+    config_path = make_bucket(tmp_path, {
+        "old": ({"file_name": "old.txt"}, b"old"),
+        "bad": ({"file_name": "bad.txt", "sha256": hashlib.sha256(b"good").hexdigest()}, b"bad")
+    })
+
+    integrity.scrub_bucket(str(tmp_path), 1024 * 1024)
+
+    files = read_config(config_path)["files"]
+    assert files["old"]["sha256"] == hashlib.sha256(b"old").hexdigest()
+    assert files["bad"]["corrupt"] is True
+
+
+@pytest.mark.parametrize("file_config", [{"file_name": "a.txt"}, {"file_name": "a.txt", "sha256": "00" * 32}])
+def test_scrub_does_not_recreate_a_file_deleted_while_hashing(tmp_path, monkeypatch, file_config):
+    config_path = make_bucket(tmp_path, {"a": (file_config, b"data")})
+    hash_file = integrity.hash_file
+
+    def hash_then_delete(file_path, algorithms, rate):
+        digests = hash_file(file_path, algorithms, rate)
+        commit(config_path, [op_delete(["files", "a"])])
+        return digests
+
+    monkeypatch.setattr(integrity, "hash_file", hash_then_delete)
+    integrity.scrub_bucket(str(tmp_path), 1024 * 1024)
+
+    assert read_config(config_path)["files"] == {}
+
+
+@pytest.mark.parametrize("rate", ["0", "-1", "nan", "inf"])
+def test_start_scrubber_rejects_invalid_rates(tmp_path, monkeypatch, rate):
+    monkeypatch.setenv("SCRUB_RATE_MB", rate)
+
+    with pytest.raises(ValueError):
+        integrity.start_scrubber(str(tmp_path))
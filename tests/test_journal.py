@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import random
+import signal
+import threading
+import subprocess
+import pytest
+import journal
+from journal import create_config, get_journal, op_set, op_delete, op_add, op_discard, op_change
+
+# Commits records to a journal from several threads and prints each record's id once commit() has returned for it
+WRITER = r"""
+import sys
+import threading
+sys.path.insert(0, sys.argv[1])
+import journal
+
+config_path = sys.argv[2]
+run = sys.argv[4]
+
+def write(thread):
+    log = "%s-%d" % (run, thread)
+    i = 0
+    while True:
+        record_id = "%s-%d" % (log, i)
+        journal.commit(config_path, [journal.op_set(["files", record_id], {"n": i}), journal.op_add(["log", log], i)])
+        sys.stdout.write(record_id + "\n")
+        sys.stdout.flush()
+        i += 1
+
+threads = [threading.Thread(target=write, args=(thread,), daemon=True) for thread in range(int(sys.argv[3]))]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+"""
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def fresh_journals(monkeypatch):
+    monkeypatch.setattr(journal, "_journals", {})
+
+
+def reopen(config_path):
+    journal.forget_journal(config_path)
+    return get_journal(config_path).read()
+
+
+def make_config(tmp_path, config):
+    config_path = str(tmp_path / "FILESERVER_BUCKET_CONFIG.fsconfig")
+    create_config(config_path, config)
+    return config_path
+
+
+def journal_lines(config_path):
+    with open(config_path + ".journal", "rb") as f:
+        return f.read().splitlines(keepends=True)
+
+
+@pytest.mark.parametrize("threads", [1, 8])
+def test_kill_mid_write_recovers_a_prefix_of_acknowledged_records(tmp_path, threads):
+    config_path = make_config(tmp_path, {"files": {}, "log": {}})
+
+    # Compact often so that some of the kills land in the middle of a compaction
+    env = dict(os.environ, JOURNAL_COMPACT_BYTES="4096")
+    rng = random.Random(threads)
+    acknowledged = set()
+
+    for run in range(5):
+        journal.commit(config_path, [op_set(["log", "%d-%d" % (run, thread)], []) for thread in range(threads)])
+
+        process = subprocess.Popen(
+            [sys.executable, "-c", WRITER, REPOSITORY, config_path, str(threads), str(run)],
+            stdout=subprocess.PIPE, text=True, env=env
+        )
+        time.sleep(rng.uniform(0.2, 0.6))
+        process.send_signal(signal.SIGKILL)
+        output, _ = process.communicate()
+        assert process.returncode == -signal.SIGKILL
+        acknowledged.update(output.split())
+
+        config = reopen(config_path)
+
+        # Nothing acknowledged is lost
+        assert acknowledged <= set(config["files"])
+
+        # Each thread's records were recovered in order and without gaps
+        for log, numbers in config["log"].items():
+            assert numbers == list(range(len(numbers)))
+            assert sorted(name for name in config["files"] if name.startswith(log + "-")) == sorted("%s-%d" % (log, i) for i in numbers)
+
+    assert acknowledged
+
+
+def test_torn_tail_is_ignored_and_cut_off(tmp_path):
+    config_path = make_config(tmp_path, {"files": {}})
+    journal.commit(config_path, [op_set(["files", "a"], 1)])
+    journal.commit(config_path, [op_set(["files", "b"], 2)])
+
+    with open(config_path + ".journal", "ab") as f:
+        f.write(journal.encode_record(3, [op_set(["files", "c"], 3)])[:-7])
+
+    assert reopen(config_path) == {"files": {"a": 1, "b": 2}}
+    assert len(journal_lines(config_path)) == 2
+
+    journal.commit(config_path, [op_set(["files", "d"], 4)])
+    assert reopen(config_path) == {"files": {"a": 1, "b": 2, "d": 4}}
+
+
+def test_bad_crc_line_and_everything_after_it_is_dropped(tmp_path):
+    config_path = make_config(tmp_path, {"files": {}})
+    for name in ["a", "b", "c"]:
+        journal.commit(config_path, [op_set(["files", name], name)])
+
+    lines = journal_lines(config_path)
+    lines[1] = b"00000000" + lines[1][8:]
+    with open(config_path + ".journal", "wb") as f:
+        f.write(b"".join(lines))
+
+    assert reopen(config_path) == {"files": {"a": "a"}}
+    assert len(journal_lines(config_path)) == 1
+
+    journal.commit(config_path, [op_set(["files", "d"], "d")])
+    assert reopen(config_path) == {"files": {"a": "a", "d": "d"}}
+
+
+def test_crash_between_snapshot_and_truncate(tmp_path, monkeypatch):
+    config_path = make_config(tmp_path, {"files": {}, "buckets": []})
+    journal.commit(config_path, [op_set(["files", "a"], 1), op_add(["buckets"], "x")])
+    journal.commit(config_path, [op_set(["files", "b"], 2), op_add(["buckets"], "y")])
+    journal.commit(config_path, [op_delete(["files", "a"]), op_discard(["buckets"], "x")])
+    expected = {"files": {"b": 2}, "buckets": ["y"]}
+
+    # Die right after the new snapshot is in place, before the journal is truncated
+    write_snapshot = journal.write_snapshot
+
+    def write_snapshot_then_crash(config_path, config, record):
+        write_snapshot(config_path, config, record)
+        raise SystemExit("crash")
+
+    with monkeypatch.context() as m:
+        m.setattr(journal, "write_snapshot", write_snapshot_then_crash)
+        m.setattr(journal, "JOURNAL_COMPACT_BYTES", 0)
+        with pytest.raises(SystemExit):
+            get_journal(config_path).commit([op_set(["files", "c"], 3)])
+    expected["files"]["c"] = 3
+
+    with open(config_path) as f:
+        assert json.load(f) == dict(expected, **{journal.SNAPSHOT_RECORD_KEY: 4})
+    assert len(journal_lines(config_path)) == 4
+
+    assert reopen(config_path) == expected
+    journal.commit(config_path, [op_set(["files", "d"], 4)])
+    expected["files"]["d"] = 4
+    assert reopen(config_path) == expected
+
+
+def test_change_feed_is_not_renumbered_by_a_crash_during_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, "CHANGE_FEED_LENGTH", 3)
+    config_path = make_config(tmp_path, {"files": {}})
+    for i in range(5):
+        journal.commit(config_path, [op_change(["changes"], {"file_id": str(i)})])
+
+    write_snapshot = journal.write_snapshot
+
+    def write_snapshot_then_crash(config_path, config, record):
+        write_snapshot(config_path, config, record)
+        raise SystemExit("crash")
+
+    with monkeypatch.context() as m:
+        m.setattr(journal, "write_snapshot", write_snapshot_then_crash)
+        m.setattr(journal, "JOURNAL_COMPACT_BYTES", 0)
+        with pytest.raises(SystemExit):
+            get_journal(config_path).commit([op_change(["changes"], {"file_id": "5"})])
+
+    feed = reopen(config_path)["changes"]
+    assert feed["sequence"] == 6
+    assert [(entry["seq"], entry["file_id"]) for entry in feed["entries"]] == [(4, "3"), (5, "4"), (6, "5")]
+
+    journal.commit(config_path, [op_change(["changes"], {"file_id": "6"})])
+    assert reopen(config_path)["changes"]["sequence"] == 7
+
+
+def test_concurrent_commits_share_an_fsync(tmp_path, monkeypatch):
+    config_path = make_config(tmp_path, {"files": {}})
+    fsyncs = []
+    fsync = os.fsync
+
+    def slow_fsync(fd):
+        fsyncs.append(fd)
+        time.sleep(0.01)
+        fsync(fd)
+
+    with monkeypatch.context() as m:
+        m.setattr(journal.os, "fsync", slow_fsync)
+        threads = [threading.Thread(target=journal.commit, args=(config_path, [op_set(["files", str(i)], i)])) for i in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(reopen(config_path)["files"]) == 50
+    assert len(fsyncs) < 50
+
+
+def test_reads_do_not_create_the_lock_file(tmp_path):
+    config_path = make_config(tmp_path, {"files": {}})
+    os.remove(config_path + ".lock")
+
+    assert reopen(config_path) == {"files": {}}
+    assert not os.path.exists(config_path + ".lock")
+
+
+def test_reads_never_modify_a_config_handed_out_earlier(tmp_path):
+    config_path = make_config(tmp_path, {"files": {"a": {"tags": ["x"]}}, "log": ["x"]})
+    before = get_journal(config_path).read()
+    snapshot = json.loads(json.dumps(before))
+
+    journal.commit(config_path, [
+        op_set(["files", "a", "name"], "a.txt"),
+        op_add(["files", "a", "tags"], "y"),
+        op_discard(["log"], "x"),
+        op_delete(["files", "b"]),
+        op_change(["changes"], {"file_id": "a"})
+    ])
+    after = get_journal(config_path).read()
+
+    assert before == snapshot
+    assert after["files"]["a"] == {"tags": ["x", "y"], "name": "a.txt"}
+    assert after["log"] == []
+    assert after["changes"]["sequence"] == 1
+
+
+def test_failed_compaction_does_not_fail_the_commit(tmp_path, monkeypatch):
+    config_path = make_config(tmp_path, {"files": {}})
+
+    def write_snapshot_fails(config_path, config, record):
+        raise OSError(28, "No space left on device")
+
+    with monkeypatch.context() as m:
+        m.setattr(journal, "write_snapshot", write_snapshot_fails)
+        m.setattr(journal, "JOURNAL_COMPACT_BYTES", 0)
+        journal.commit(config_path, [op_set(["files", "a"], 1)])
+
+    assert reopen(config_path) == {"files": {"a": 1}}
+
+    # The next write past the threshold compacts
+    monkeypatch.setattr(journal, "JOURNAL_COMPACT_BYTES", 0)
+    journal.commit(config_path, [op_set(["files", "b"], 2)])
+    assert journal_lines(config_path) == []
+    assert reopen(config_path) == {"files": {"a": 1, "b": 2}}
+
+
+def test_slow_recovery_does_not_block_other_configs(tmp_path):
+    fcntl = pytest.importorskip("fcntl")
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    blocked_path = make_config(tmp_path / "a", {"files": {}})
+    other_path = make_config(tmp_path / "b", {"files": {}})
+
+    # Another worker holds the lock, so recovering the first config has to wait for it
+    with open(blocked_path + ".lock") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        thread = threading.Thread(target=get_journal, args=(blocked_path,), daemon=True)
+        thread.start()
+        time.sleep(0.1)
+        assert thread.is_alive()
+
+        started = time.monotonic()
+        assert get_journal(other_path).read() == {"files": {}}
+        assert time.monotonic() - started < 1
+
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+@pytest.mark.parametrize("length", ["0", "-5"])
+def test_change_feed_length_must_be_positive(length):
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys; sys.path.insert(0, sys.argv[1]); import journal", REPOSITORY],
+        env=dict(os.environ, CHANGE_FEED_LENGTH=length), capture_output=True, text=True
+    )
+
+    assert result.returncode != 0
+    assert "CHANGE_FEED_LENGTH must be a positive integer" in result.stderr
@@ -0,0 +1,161 @@
+import io
+import os
+import base64
+import time
+import hashlib
+import tempfile
+import threading
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("flask_cors")
+pytest.importorskip("jwt")
+
+# routes reads its settings when it is imported
+os.environ.update({
+    "FILE_STORAGE_LOCATION": tempfile.mkdtemp(),
+    "DEFAULT_ADMIN": "admin@example.com",
+    "MAXIMUM_FILE_SIZE": "10",
+    "MSAL_TENANT_ID": "tenant",
+    "MSAL_CLIENT_ID": "client"
+})
+
+import journal
+import routes
+from app import create_app
+
+HEADERS = {"Authorization": "Bearer token"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(routes, "verifyUser", lambda token, file_storage_location: "admin@example.com")
+    return create_app().test_client()
+
+
+@pytest.fixture
+def bucket_id(client):
+    return client.post("/buckets", json={"bucket_name": "test"}, headers=HEADERS).get_json()["bucket_id"]
+
+
+def upload(client, bucket_id, data=b"data", headers=None, status=200):
+    response = client.post(
+        "/buckets/" + bucket_id + "/files",
+        data={"file": (io.BytesIO(data), "file.txt")},
+        headers=dict(HEADERS, **(headers or {}))
+    )
+    assert response.status_code == status
+    return response.get_json().get("file_id")
+
+
+def file_digest(algorithm, data):
+    return algorithm.replace("sha", "sha-") + "=:" + base64.b64encode(hashlib.new(algorithm, data).digest()).decode() + ":"
+
+
+def stored_files(bucket_id):
+    return [name for name in os.listdir(os.path.join(routes.file_storage_location, bucket_id)) if "FILESERVER_" not in name]
+
+
+@pytest.mark.parametrize("algorithm", ["sha256", "sha512", "md5"])
+def test_upload_accepts_a_matching_file_digest(client, bucket_id, algorithm):
+    file_id = upload(client, bucket_id, b"data", {"X-File-Digest": file_digest(algorithm, b"data")})
+
+    assert stored_files(bucket_id) == [file_id]
+
+
+def test_upload_rejects_a_mismatching_file_digest_and_removes_the_file(client, bucket_id):
+    upload(client, bucket_id, b"data", {"X-File-Digest": file_digest("sha256", b"other")}, status=400)
+
+    assert stored_files(bucket_id) == []
+    assert client.get("/buckets/" + bucket_id + "/files", headers=HEADERS).get_json() == []
+
+
+@pytest.mark.parametrize("value", ["sha-256=abc", "sha-256=:not base64!:", "md5=:"])
+def test_upload_rejects_a_malformed_file_digest(client, bucket_id, value):
+    upload(client, bucket_id, b"data", {"X-File-Digest": value}, status=400)
+
+    assert stored_files(bucket_id) == []
+
+
+def test_upload_ignores_body_digests(client, bucket_id):
+    # These describe the whole multipart body, so they never match the file and must not be checked against it
+    upload(client, bucket_id, b"data", {
+        "Content-Digest": file_digest("sha256", b"data"),
+        "Content-MD5": base64.b64encode(hashlib.md5(b"data").digest()).decode()
+    })
+
+
+def test_checksums_are_listed_and_returned_on_download(client, bucket_id):
+    file_id = upload(client, bucket_id, b"data")
+    sha256 = hashlib.sha256(b"data").hexdigest()
+
+    listing = client.get("/buckets/" + bucket_id + "/files", headers=HEADERS).get_json()
+    assert [(entry["file_id"], entry["sha256"]) for entry in listing] == [(file_id, sha256)]
+
+    expected = file_digest("sha256", b"data")
+    download = client.get("/buckets/" + bucket_id + "/files/" + file_id, headers=HEADERS)
+    assert download.data == b"data"
+    assert download.headers["Repr-Digest"].split(", ")[0] == expected
+
+    head = client.head("/buckets/" + bucket_id + "/files/" + file_id, headers=HEADERS)
+    assert head.status_code == 200
+    assert head.data == b""
+    assert head.headers["Repr-Digest"].split(", ")[0] == expected
+
+
+@pytest.mark.parametrize("wait", ["nan", "inf", "-1", "soon"])
+def test_changes_rejects_invalid_wait(client, bucket_id, wait):
+    response = client.get("/buckets/" + bucket_id + "/changes?since=0&wait=" + wait, headers=HEADERS)
+    assert response.status_code == 400
+
+
+def test_changes_returns_deltas_after_since(client, bucket_id):
+    file_id = upload(client, bucket_id)
+    client.delete("/buckets/" + bucket_id + "/files/" + file_id, headers=HEADERS)
+
+    response = client.get("/buckets/" + bucket_id + "/changes?since=1", headers=HEADERS).get_json()
+    assert response["sequence"] == 2
+    assert [(change["seq"], change["action"]) for change in response["changes"]] == [(2, "delete")]
+
+
+def test_long_poll_returns_as_soon_as_something_changes(client, bucket_id):
+    uploader = threading.Timer(0.5, upload, args=(client.application.test_client(), bucket_id))
+    uploader.start()
+
+    started = time.monotonic()
+    response = client.get("/buckets/" + bucket_id + "/changes?since=0&wait=5", headers=HEADERS)
+    elapsed = time.monotonic() - started
+    uploader.join()
+
+    assert response.status_code == 200
+    assert [(change["seq"], change["action"]) for change in response.get_json()["changes"]] == [(1, "upload")]
+    assert 0.4 < elapsed < 3
+
+
+def test_trimmed_feed_gives_clients_a_new_cursor(client, bucket_id, monkeypatch):
+    monkeypatch.setattr(journal, "CHANGE_FEED_LENGTH", 2)
+    for _ in range(4):
+        upload(client, bucket_id)
+
+    response = client.get("/buckets/" + bucket_id + "/changes?since=0", headers=HEADERS)
+    assert response.status_code == 410
+    assert response.get_json()["sequence"] == 4
+
+    listing = client.get("/buckets/" + bucket_id + "/files", headers=HEADERS)
+    assert len(listing.get_json()) == 4
+    assert listing.headers["X-Change-Sequence"] == "4"
+
+    since = listing.headers["X-Change-Sequence"]
+    response = client.get("/buckets/" + bucket_id + "/changes?since=" + since, headers=HEADERS)
+    assert response.status_code == 200
+    assert response.get_json()["changes"] == []
+
+
+def test_event_stream_ends_within_the_maximum_wait(client, bucket_id, monkeypatch):
+    monkeypatch.setattr(routes, "MAXIMUM_CHANGES_WAIT", 0.2)
+    upload(client, bucket_id)
+
+    response = client.get("/buckets/" + bucket_id + "/changes?since=0", headers=dict(HEADERS, Accept="text/event-stream"))
+    body = response.get_data(as_text=True)
+
+    assert "id: 1\nevent: change\n" in body
@@ -7,6 +7,7 @@ import json
 from urllib.request import urlopen
 import os
 from dotenv import load_dotenv
+from journal import read_config
 
 load_dotenv()
 
@@ -30,8 +31,7 @@ def verifyUser(token, filestorage_location):
         return None
 
 def isUserValid(user, filestorage_location):
-    with open(os.path.join(filestorage_location, "FILESERVER_PERMISSIONS.fsconfig"), "r") as f:
-        permissions = json.load(f)
+    permissions = read_config(os.path.join(filestorage_location, "FILESERVER_PERMISSIONS.fsconfig"))
 
     if user in permissions:
         return True